@@ -4,17 +4,21 @@ from __future__ import annotations
 import os
 import json
 import numpy as np
-from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional
+import orjson
+import re2
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
 
 from flask import Flask, jsonify, render_template, request
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Integer, String, Date, DateTime, Text
+from sqlalchemy import Integer, String, Date, DateTime, Text, event, func, select
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.types import JSON as SA_JSON
 
+from numba import njit
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 
 
 # ------------------------------------------------------------------------------
@@ -22,12 +26,60 @@ from sklearn.metrics.pairwise import cosine_similarity
 # ------------------------------------------------------------------------------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+
+class ORJSONProvider(JSONProvider):
+    """
+    JSON provider backed by orjson, so dates, datetimes and numpy values are
+    serialised natively. Naive datetimes (SQLite drops the tz) are stored as UTC.
+    """
+
+    option = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_SORT_KEYS
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype="application/json")
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(BASE_DIR, "travel.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_pre_ping": True,
+    "connect_args": {"check_same_thread": False},
+}
 
 db = SQLAlchemy(app)
 
+# Applied to every new pooled connection: WAL lets readers run alongside a
+# writer, and the larger page cache / mmap stay warm across requests.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
+)
+
+
+def _set_sqlite_pragmas(dbapi_conn, _conn_record) -> None:
+    cur = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cur.execute(pragma)
+    cur.close()
+
+
+with app.app_context():
+    event.listen(db.engine, "connect", _set_sqlite_pragmas)
+
 
 # ------------------------------------------------------------------------------
 # Models
@@ -79,7 +131,7 @@ def _ensure_state_row() -> AppState:
     """
     Ensure we always have a single AppState row with id=1.
     """
-    s = AppState.query.get(1)
+    s = db.session.get(AppState, 1)
     if not s:
         s = AppState(id=1, visited=[], planned=[])
         db.session.add(s)
@@ -87,35 +139,163 @@ def _ensure_state_row() -> AppState:
     return s
 
 
-def _parse_date_yyyy_mm_dd(value: Optional[str]) -> Optional[datetime.date]:
+def _parse_date_yyyy_mm_dd(value: Optional[str]) -> Optional[date]:
     if not value:
         return None
+    # Fast path for the canonical form only: fromisoformat would also accept
+    # "20240101" or week dates like "2024-W01-1", which strptime rejects.
+    if len(value) == 10 and value[4] == "-" and value[7] == "-":
+        return date.fromisoformat(value)
     return datetime.strptime(value, "%Y-%m-%d").date()
 
 
 def _uniq_sorted(values: List[str]) -> List[str]:
-    return sorted({(v or "").strip() for v in values if (v or "").strip()})
+    return sorted(dict.fromkeys(s for s in (v.strip() for v in values if v) if s))
+
+
+@njit(fastmath=True, cache=True)
+def _score_csr_dot(data, indices, indptr, pref):
+    """
+    Dot product of every row of a CSR matrix (given as its data/indices/indptr
+    arrays) with the dense vector pref.
+    """
+    n_rows = indptr.size - 1
+    out = np.empty(n_rows, np.float32)
+    for i in range(n_rows):
+        s = np.float32(0.0)
+        for k in range(indptr[i], indptr[i + 1]):
+            s += data[k] * pref[indices[k]]
+        out[i] = s
+    return out
+
+
+# Compile (or load from the on-disk cache) at import for the dtypes scipy's
+# float32 CSR matrices use, so the first suggestions request doesn't pay for it.
+_score_csr_dot(
+    np.zeros(1, np.float32), np.zeros(1, np.int32), np.array([0, 1], np.int32), np.zeros(1, np.float32)
+)
+
 
+# (mtime_ns, parsed country_cities.json), reused until the file's mtime changes.
+# Replaced as a whole so concurrent readers never see an mtime from one load
+# paired with data from another.
+_CATALOG_CACHE: Tuple[Optional[int], Dict[str, Tuple[str, ...]]] = (None, {})
 
-def _load_country_city_catalog() -> Dict[str, List[str]]:
+
+def _load_country_city_catalog() -> Tuple[Optional[int], Dict[str, Tuple[str, ...]]]:
     """
-    static/data/country_cities.json
+    Return (mtime_ns, catalog) for static/data/country_cities.json
     {
       "Spain": ["Granada", "Seville", ...],
       ...
     }
     """
+    global _CATALOG_CACHE
+
     path = os.path.join(app.root_path, "static", "data", "country_cities.json")
-    if not os.path.exists(path):
-        return {}
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None, {}
+    cached = _CATALOG_CACHE
+    if cached[0] == mtime:
+        return cached
+
     with open(path, "r", encoding="utf-8") as f:
         data = json.load(f)
     # normalise
-    out: Dict[str, List[str]] = {}
+    out: Dict[str, Tuple[str, ...]] = {}
     for k, v in (data or {}).items():
         if isinstance(k, str) and isinstance(v, list):
-            out[k.strip()] = _uniq_sorted([str(x) for x in v])
-    return out
+            out[k.strip()] = tuple(_uniq_sorted([str(x) for x in v]))
+
+    _CATALOG_CACHE = (mtime, out)
+    return mtime, out
+
+
+# Same tokens as sklearn's default r"(?u)\b\w\w+\b", but matched by RE2's DFA
+# instead of backtracking `re`. RE2's \w is ASCII-only, hence the Unicode classes.
+TOKEN_RE = re2.compile(r"[\pL\pN_]{2,}")
+
+
+# Fitted TF-IDF model for the suggestions endpoint, reused until trips or the
+# catalog change: (key, vectorizer, pref_vec, candidate_matrix, country_rows).
+# Replaced as a whole so a reader never mixes parts of two different fits.
+_SUGG_CACHE: Optional[Tuple[Any, ...]] = None
+
+
+def _suggestion_model(catalog_mtime: Optional[int], country_cities: Dict[str, Tuple[str, ...]]):
+    """
+    Return (vectorizer, pref_vec, candidate_matrix, country_rows).
+
+    The vectorizer is fitted on the travel history plus one "<country> <city>"
+    doc per catalog entry. candidate_matrix holds the TF-IDF rows of those
+    catalog docs and country_rows maps each country to its slice of rows.
+
+    Cached on catalog_mtime (returned together with country_cities) and a
+    (max(created_at), count) fingerprint of the trip table, so it is only
+    rebuilt when either changes. vectorizer, pref_vec and candidate_matrix are
+    None when there is no history yet.
+    """
+    global _SUGG_CACHE
+
+    trips_key = db.session.execute(select(func.max(Trip.created_at), func.count(Trip.id))).one()
+    key = (catalog_mtime, *trips_key)
+    cached = _SUGG_CACHE
+    if cached is not None and cached[0] == key:
+        return cached[1:]
+
+    trips = db.session.execute(
+        select(Trip.country, Trip.cities, Trip.notes, Trip.companions).order_by(Trip.created_at.desc())
+    ).all()
+
+    # Build preference corpus from visited trips (country + cities + notes + companions)
+    visited_docs: List[str] = []
+    for t in trips:
+        doc = " ".join(
+            [
+                (t.country or "").strip(),
+                " ".join(t.cities or []),
+                (t.notes or "").strip(),
+                " ".join(t.companions or []),
+            ]
+        ).strip()
+        if doc:
+            visited_docs.append(doc)
+
+    # One candidate doc per catalog city; rows of each country are contiguous
+    candidate_docs: List[str] = []
+    country_rows: Dict[str, slice] = {}
+    for country, cities in country_cities.items():
+        start = len(candidate_docs)
+        candidate_docs.extend(f"{country} {city}" for city in cities)
+        country_rows[country] = slice(start, len(candidate_docs))
+
+    vectorizer: Optional[TfidfVectorizer] = None
+    pref_vec: Optional[np.ndarray] = None
+    candidate_matrix: Optional[sparse.csr_matrix] = None
+    if visited_docs:
+        vectorizer = TfidfVectorizer(
+            stop_words="english",
+            tokenizer=TOKEN_RE.findall,
+            token_pattern=None,
+            ngram_range=(1, 2),
+            max_features=6000,
+            sublinear_tf=True,
+            norm="l2",
+            dtype=np.float32,
+        )
+        X = vectorizer.fit_transform(visited_docs + candidate_docs)
+        visited_vecs = X[: len(visited_docs)]
+        candidate_matrix = X[len(visited_docs) :]
+
+        # L2-normalise once; TF-IDF rows are already unit length, so a plain
+        # dot product against this vector is the cosine similarity.
+        pref_vec = np.asarray(visited_vecs.mean(axis=0), dtype=np.float32).ravel()
+        pref_vec /= np.linalg.norm(pref_vec) + 1e-12
+
+    _SUGG_CACHE = (key, vectorizer, pref_vec, candidate_matrix, country_rows)
+    return vectorizer, pref_vec, candidate_matrix, country_rows
 
 
 # ------------------------------------------------------------------------------
@@ -137,25 +317,25 @@ def suggestions_page():
 @app.get("/api/state")
 def api_get_state():
     s = _ensure_state_row()
-    trips = Trip.query.order_by(Trip.created_at.desc()).all()
+    # Plain column rows (no ORM instances); field names match the response keys
+    rows = db.session.execute(
+        select(
+            Trip.id,
+            Trip.country,
+            Trip.start_date,
+            Trip.end_date,
+            Trip.cities,
+            Trip.companions,
+            Trip.notes,
+            Trip.created_at,
+        ).order_by(Trip.created_at.desc())
+    ).all()
 
     return jsonify(
         {
-            "visited": s.visited or [],
-            "planned": s.planned or [],
-            "trips": [
-                {
-                    "id": t.id,
-                    "country": t.country,
-                    "start_date": t.start_date.isoformat() if t.start_date else None,
-                    "end_date": t.end_date.isoformat() if t.end_date else None,
-                    "cities": t.cities or [],
-                    "companions": t.companions or [],
-                    "notes": t.notes or "",
-                    "created_at": t.created_at.isoformat(),
-                }
-                for t in trips
-            ],
+            "visited": s.visited,
+            "planned": s.planned,
+            "trips": [row._asdict() for row in rows],
         }
     )
 
@@ -198,6 +378,8 @@ def api_add_trip():
     if not isinstance(cities, list) or not isinstance(companions, list):
         return jsonify({"ok": False, "error": "cities/companions must be lists"}), 400
 
+    s = _ensure_state_row()
+
     t = Trip(
         country=country,
         start_date=start_date,
@@ -207,22 +389,26 @@ def api_add_trip():
         notes=notes,
     )
     db.session.add(t)
-    db.session.commit()
 
     # Optional: auto-add to visited when a trip is added
-    s = _ensure_state_row()
-    if country not in (s.visited or []):
-        s.visited = _uniq_sorted((s.visited or []) + [country])
+    visited = set(s.visited or [])
+    if country not in visited:
+        visited.add(country)
         # remove from planned if present
-        s.planned = [c for c in (s.planned or []) if c != country]
-        db.session.commit()
+        planned = set(s.planned or [])
+        planned.discard(country)
+        s.visited = sorted(visited)
+        s.planned = sorted(planned)
+
+    # trip + state update in one transaction (one fsync)
+    db.session.commit()
 
     return jsonify({"ok": True, "trip_id": t.id})
 
 
 @app.delete("/api/trips/<int:trip_id>")
 def api_delete_trip(trip_id: int):
-    t = Trip.query.get(trip_id)
+    t = db.session.get(Trip, trip_id)
     if not t:
         return jsonify({"ok": False, "error": "trip not found"}), 404
 
@@ -239,24 +425,8 @@ def api_suggestions():
     s = _ensure_state_row()
     planned = s.planned or []
 
-    trips = Trip.query.order_by(Trip.created_at.desc()).all()
-
-    # Build preference corpus from visited trips (country + cities + notes + companions)
-    visited_docs: List[str] = []
-    for t in trips:
-        doc = " ".join(
-            [
-                (t.country or "").strip(),
-                " ".join(t.cities or []),
-                (t.notes or "").strip(),
-                " ".join(t.companions or []),
-            ]
-        ).strip()
-        if doc:
-            visited_docs.append(doc)
-
     # Load local city catalog
-    country_cities = _load_country_city_catalog()
+    catalog_mtime, country_cities = _load_country_city_catalog()
     if not country_cities:
         return jsonify(
             {
@@ -265,13 +435,19 @@ def api_suggestions():
             }
         ), 400
 
-    # Build candidates from planned countries
-    candidates: List[Dict[str, Any]] = []
+    # Build candidates from planned countries as parallel arrays indexed by row;
+    # rows of each country are contiguous
+    city_lists: List[Tuple[str, ...]] = []
+    country_to_idx: Dict[str, np.ndarray] = {}
+    n_candidates = 0
     for country in planned:
-        for city in country_cities.get(country, []):
-            candidates.append({"country": country, "city": city, "doc": f"{country} {city}"})
+        cities = country_cities.get(country, ())
+        if cities:
+            city_lists.append(cities)
+            country_to_idx[country] = np.arange(n_candidates, n_candidates + len(cities))
+            n_candidates += len(cities)
 
-    if not candidates:
+    if not n_candidates:
         return jsonify(
             {
                 "ok": True,
@@ -280,54 +456,52 @@ def api_suggestions():
             }
         )
 
+    vectorizer, pref_vec, candidate_matrix, country_rows = _suggestion_model(catalog_mtime, country_cities)
+
+    cand_cities = np.empty(n_candidates, dtype=object)
+    cand_cities[:] = [city for cities in city_lists for city in cities]
+
     # If no travel history yet, fallback to a simple list (no ML signal)
-    if not visited_docs:
-        out: Dict[str, List[Dict[str, Any]]] = {}
-        for c in candidates:
-            out.setdefault(c["country"], []).append(
+    if vectorizer is None:
+        out: Dict[str, List[Dict[str, Any]]] = {
+            country: [
                 {
-                    "city": c["city"],
+                    "city": city,
                     "score": 0.10,
                     "reason": "No past trips yet — showing starter cities.",
                 }
-            )
-        # cap
-        for k in out:
-            out[k] = out[k][:8]
+                for city in cand_cities[idx[:8]]
+            ]
+            for country, idx in country_to_idx.items()
+        }
         return jsonify({"ok": True, "suggestions": out})
 
-    # TF-IDF similarity between preference profile and candidate docs
-    candidate_docs = [c["doc"] for c in candidates]
-    all_docs = visited_docs + candidate_docs
-
-    vectorizer = TfidfVectorizer(stop_words="english", ngram_range=(1, 2), max_features=6000)
-    X = vectorizer.fit_transform(all_docs)
-
-    visited_vecs = X[: len(visited_docs)]
-    cand_vecs = X[len(visited_docs) :]
-
-    pref_vec = np.asarray(visited_vecs.mean(axis=0))  # convert np.matrix -> ndarray
-    sims = cosine_similarity(cand_vecs, pref_vec).reshape(-1)
+    # TF-IDF similarity between preference profile and the planned countries' rows
+    cand_vecs = sparse.vstack(
+        [candidate_matrix[country_rows[country]] for country in country_to_idx], format="csr"
+    )
 
-    # Build output: top per country
-    scored = list(zip(candidates, sims))
-    scored.sort(key=lambda x: x[1], reverse=True)
+    sims = _score_csr_dot(cand_vecs.data, cand_vecs.indices, cand_vecs.indptr, pref_vec)
 
+    # Build output: top per country (partition to the best 8, then sort only those).
+    # Ties at the 8th score are filled in catalog order, like a stable full sort.
     out: Dict[str, List[Dict[str, Any]]] = {}
-    for c, score in scored:
-        country = c["country"]
-        if country not in out:
-            out[country] = []
-        if len(out[country]) >= 8:
-            continue
-
-        out[country].append(
+    for country, idx in country_to_idx.items():
+        if len(idx) > 8:
+            kth = np.partition(sims[idx], len(idx) - 8)[len(idx) - 8]
+            above = idx[sims[idx] > kth]
+            tied = idx[sims[idx] == kth]
+            idx = np.concatenate([above, tied[: 8 - len(above)]])
+        top = idx[np.argsort(-sims[idx], kind="stable")]
+
+        out[country] = [
             {
-                "city": c["city"],
+                "city": city,
                 "score": float(score),
                 "reason": f"Matches your travel profile (score {float(score):.2f}).",
             }
-        )
+            for city, score in zip(cand_cities[top], sims[top])
+        ]
 
     return jsonify({"ok": True, "suggestions": out})
 